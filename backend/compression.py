@@ -0,0 +1,65 @@
+import gzip
+from functools import lru_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+"""
+Response compression
+
+Bodies at or above COMPRESSION_MIN_SIZE bytes are compressed with the best
+encoding the client accepts. Listings are often identical between requests,
+so compressed bodies are kept in a small LRU cache keyed on the raw body.
+Brotli is only offered when the optional `brotli` package is installed.
+"""
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_CACHE_SIZE = 128
+
+
+def supported_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+"""
+choose_encoding(accept_encodings)
+    picks the supported encoding the client prefers, or None
+"""
+def choose_encoding(accept_encodings):
+    encodings = supported_encodings()
+    best = accept_encodings.best_match(encodings)
+    # best_match falls back to '*'-only matches; make sure it is one we know
+    return best if best in encodings else None
+
+
+@lru_cache(maxsize=COMPRESSION_CACHE_SIZE)
+def compress(encoding, body):
+    if encoding == 'br':
+        return brotli.compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+
+"""
+compress_response(response, accept_encodings, min_size)
+    compresses a buffered response in place when it is worth doing
+"""
+def compress_response(response, accept_encodings, min_size=COMPRESSION_MIN_SIZE):
+    response.vary.add('Accept-Encoding')
+
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+
+    response.set_data(compress(encoding, body))
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -1,22 +1,101 @@
-from flask import Flask, request, abort, jsonify
+import math
+import os
+import click
+from flask import Flask, request, abort, jsonify, g
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import random
-from models import setup_db, Question, Category
+from models import setup_db, table_versions, Question, Category
+from compression import compress_response, COMPRESSION_MIN_SIZE
+from snapshot import export_snapshot, load_snapshot
+from throttle import SingleFlight, TokenBucketLimiter
 
 QUESTIONS_PER_PAGE = 10
 
+# Routes limited per client, and the default token bucket for each client
+RATE_LIMITED_ENDPOINTS = {'play_quiz', 'search_questions'}
+RATE_LIMIT_PER_SECOND = 5
+RATE_LIMIT_BURST = 20
+
+# GET routes answered with weak ETags so unchanged listings get a 304
+LISTING_ENDPOINTS = {'get_categories', 'get_questions', 'get_category_questions'}
+
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.update(test_config)
+
+    # Read-only nodes serve questions and categories from a memory-mapped
+    # snapshot (see snapshot.py) instead of the database
+    snapshot_path = app.config.get('SNAPSHOT_PATH', os.environ.get('TRIVIA_SNAPSHOT'))
+    snapshot = load_snapshot(snapshot_path) if snapshot_path else None
+
+    if snapshot is None:
+        setup_db(app)
+
+        @app.cli.command('export-snapshot')
+        @click.argument('path')
+        def export_snapshot_command(path):
+            export_snapshot(path)
 
     """
     @TODO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     """
     CORS(app)
 
+    # Behind reverse proxies (or the frontend dev proxy) remote_addr is the
+    # proxy, so trust that many X-Forwarded-For hops to find the client
+    trusted_proxies = int(app.config.get('TRUSTED_PROXIES',
+                                         os.environ.get('TRIVIA_TRUSTED_PROXIES', 0)))
+    if trusted_proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies)
+
+    # Identical concurrent reads share a single database query
+    single_flight = SingleFlight()
+
+    rate_limiter = TokenBucketLimiter(
+        app.config.get('RATE_LIMIT_PER_SECOND', RATE_LIMIT_PER_SECOND),
+        app.config.get('RATE_LIMIT_BURST', RATE_LIMIT_BURST))
+
+    @app.before_request
+    def limit_request_rate():
+        # CORS preflight OPTIONS requests do not cost a token
+        if request.method != 'POST' or request.endpoint not in RATE_LIMITED_ENDPOINTS:
+            return None
+
+        if not rate_limiter.allow(request.remote_addr):
+            g.retry_after = rate_limiter.retry_after(request.remote_addr)
+            abort(429)
+
+    def listing_etag(versions):
+        return 'questions-{}-categories-{}'.format(*versions)
+
+    def versioned(query):
+        # Read the table versions before the data, so an ETag never names a
+        # newer version than the body it is attached to
+        return table_versions('questions', 'categories'), query()
+
+    @app.before_request
+    def check_listing_etag():
+        if request.method != 'GET' or request.endpoint not in LISTING_ENDPOINTS:
+            return None
+
+        if snapshot is not None:
+            # A snapshot never changes while it is being served
+            etag = g.etag = f'snapshot-{snapshot.version}'
+        else:
+            # Only a pre-check; routes tag their body with the version they read
+            etag = listing_etag(single_flight.do(
+                'table_versions', lambda: table_versions('questions', 'categories')))
+
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
     """
     @TODO: Use the after_request decorator to set Access-Control-Allow
     """
@@ -34,6 +113,17 @@ def create_app(test_config=None):
             'GET,POST,PUT,DELETE,UPDATE,OPTIONS')
 
         return response
+
+    @app.after_request
+    def add_etag_and_compress(response):
+        etag = g.get('etag')
+        if etag is not None and response.status_code == 200:
+            response.set_etag(etag, weak=True)
+
+        return compress_response(
+            response,
+            request.accept_encodings,
+            app.config.get('COMPRESSION_MIN_SIZE', COMPRESSION_MIN_SIZE))
     """
     @TODO:
     Create an endpoint to handle GET requests
@@ -44,9 +134,24 @@ def create_app(test_config=None):
     @app.route("/categories", methods=["GET"])
     def get_categories():
 
-        
+        if snapshot is not None:
+            categories = snapshot.categories()
+
+            # Match the database path when there are no categories
+            if not categories:
+                abort(404)
+
+            return jsonify({
+                "success": True,
+                "categories": categories
+            })
+
         # Retrieve all categories in the database and order them by their type
-        categories = Category.query.order_by(Category.type).all()
+        versions, categories = single_flight.do(
+            'categories',
+            lambda: versioned(lambda: {category.id: category.type
+                                       for category in Category.query.order_by(Category.type).all()}))
+        g.etag = listing_etag(versions)
 
 
         # If there are no categories in the database, return a 404 error
@@ -58,7 +163,7 @@ def create_app(test_config=None):
         return jsonify(
             {
                 "success": True, 
-                "categories": {category.id: category.type for category in categories}
+                "categories": categories
             }
         )
 
@@ -77,8 +182,29 @@ def create_app(test_config=None):
     """
     @app.route('/questions', methods=['GET'])
     def get_questions():
-        all_questions = Question.query.order_by(Question.id).all()
+        if snapshot is not None:
+            return get_snapshot_questions()
+
         page = request.args.get('page', 1, type=int)
+
+        # Requests for the same page arriving together share one query
+        versions, (paginated_questions, total_questions, categories) = single_flight.do(
+            ('questions', page), lambda: versioned(lambda: query_questions_page(page)))
+        g.etag = listing_etag(versions)
+
+        if len(paginated_questions) == 0:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'questions': paginated_questions,
+            'total_questions': total_questions,
+            'categories': categories,
+            'current_category': None
+        })
+
+    def query_questions_page(page):
+        all_questions = Question.query.order_by(Question.id).all()
         
         
         # Creating start and end points based on static variable QUESTIONS_PER_PAGE 
@@ -92,16 +218,24 @@ def create_app(test_config=None):
 
         categories = Category.query.order_by(Category.type).all()
 
-        
+        return (paginated_questions,
+                len(all_questions),
+                {category.id: category.type for category in categories})
+
+    def get_snapshot_questions():
+        page = request.args.get('page', 1, type=int)
+        start = (page - 1) * QUESTIONS_PER_PAGE
+
+        paginated_questions = snapshot.questions(start, start + QUESTIONS_PER_PAGE)
+
         if len(paginated_questions) == 0:
             abort(404)
 
         return jsonify({
             'success': True,
             'questions': paginated_questions,
-            'total_questions': len(all_questions),
-            'categories': {category.id: category.type
-                           for category in categories},
+            'total_questions': snapshot.question_count,
+            'categories': snapshot.categories(),
             'current_category': None
         })
 
@@ -115,6 +249,10 @@ def create_app(test_config=None):
 
     @app.route("/questions/<int:question_id>", methods=["DELETE"])
     def delete_question(question_id: int):
+
+        # Snapshots are read-only
+        if snapshot is not None:
+            abort(405)
        
         # Get the question from the database using the question_id passed in the URL
         question = Question.query.get(question_id)
@@ -149,6 +287,10 @@ def create_app(test_config=None):
     """
     @app.route('/questions', methods=['POST'])
     def create_question():
+        # Snapshots are read-only
+        if snapshot is not None:
+            abort(405)
+
         # Get data from the request body in JSON format
         body = request.get_json()
 
@@ -213,9 +355,13 @@ def create_app(test_config=None):
         
         
         # Use the filter method to search for questions that contain the search term
-        search_results = (
-            Question.query.filter(Question.question.ilike(f"%{search_term}%")).all()
-        )
+        if snapshot is not None:
+            search_results = snapshot.search(search_term)
+        else:
+            search_results = [
+                question.format() for question in
+                Question.query.filter(Question.question.ilike(f"%{search_term}%")).all()
+            ]
         
 
         # If no matching questions are found, return a not found error        
@@ -230,7 +376,7 @@ def create_app(test_config=None):
         return jsonify(
             {
                 "success": True,
-                "questions": [question.format() for question in search_results],
+                "questions": search_results,
                 "total_questions": len(search_results),
                 "current_category": None,
             }
@@ -250,7 +396,14 @@ def create_app(test_config=None):
 
 
         # Get all questions that match the category_id
-        questions = Question.query.filter(Question.category == category_id).all()
+        if snapshot is not None:
+            questions = snapshot.questions_in_category(category_id)
+        else:
+            versions, questions = versioned(lambda: [
+                question.format() for question in
+                Question.query.filter(Question.category == category_id).all()
+            ])
+            g.etag = listing_etag(versions)
 
 
         # If no questions are found for the given category_id, return a 404 error
@@ -261,7 +414,7 @@ def create_app(test_config=None):
         # Return a json object containing success status, list of questions, total number of questions, and the current category id
         return jsonify({
             'success': True,
-            'questions': [question.format() for question in questions],
+            'questions': questions,
             'total_questions': len(questions),
             'current_category': category_id
         })
@@ -302,6 +455,20 @@ def create_app(test_config=None):
             
             
             # Determine the questions to be used based on the category and previous questions
+            if snapshot is not None:
+                category_id = None if quiz_category["type"] == "click" else int(quiz_category["id"])
+                available_questions = snapshot.quiz_candidates(category_id, previous_questions)
+
+                if available_questions:
+                    new_question = snapshot.format_question(random.choice(available_questions))
+                else:
+                    new_question = None
+
+                return jsonify({
+                    "success": True,
+                    "question": new_question
+                })
+
             if quiz_category["type"] == "click":
                 available_questions = Question.query.filter(
                     Question.id.notin_(previous_questions)
@@ -351,6 +518,14 @@ def create_app(test_config=None):
             'message': 'Bad Request',
         }), 400
 
+    @app.errorhandler(405)
+    def method_not_allowed(error):
+        return jsonify({
+            'success': False,
+            'error': 405,
+            'message': 'Method Not Allowed'
+        }), 405
+
     @app.errorhandler(422)
     def unable_to_process(error):
         return jsonify({
@@ -359,6 +534,16 @@ def create_app(test_config=None):
             'message': 'Unable to process request'
         }), 422
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            'success': False,
+            'error': 429,
+            'message': 'Too Many Requests'
+        })
+        response.headers['Retry-After'] = str(max(1, math.ceil(g.get('retry_after', 1))))
+        return response, 429
+
     @app.errorhandler(500)
     def unable_to_process(error):
         return jsonify({
@@ -1,5 +1,6 @@
 import os
 from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy.dialects.postgresql import insert
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -20,6 +21,38 @@ def setup_db(app, database_path=database_path):
     db.init_app(app)
     db.create_all()
 
+"""
+TableVersion
+    counts writes to a table so listings can be revalidated with ETags
+"""
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+"""
+bump_version(name)
+    increments the version of a table inside the current transaction,
+    creating its row on the first write without racing other writers
+"""
+def bump_version(name):
+    versions = TableVersion.__table__
+    db.session.execute(
+        insert(versions)
+        .values(name=name, version=1)
+        .on_conflict_do_update(index_elements=[versions.c.name],
+                               set_={'version': versions.c.version + 1}))
+
+"""
+table_versions(*names)
+    returns the current version of each named table, 0 if never written
+"""
+def table_versions(*names):
+    versions = dict(TableVersion.query.filter(TableVersion.name.in_(names))
+                    .with_entities(TableVersion.name, TableVersion.version))
+    return tuple(versions.get(name, 0) for name in names)
+
 """
 Question
 
@@ -41,13 +74,16 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_version(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        bump_version(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__)
         db.session.commit()
 
     def format(self):
@@ -0,0 +1,217 @@
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+
+from models import Question, Category
+
+"""
+Snapshot file layout
+
+A snapshot is a read-only, columnar copy of the questions and categories
+tables that can be memory-mapped and served without touching the database.
+All integers are stored in native byte order, so a snapshot should be
+loaded on the same kind of machine that exported it.
+
+    header      magic, version, question count, category count, blob size
+    q_ids       int32[question count], ordered by question id
+    q_diff      int32[question count]
+    q_cat       int32[question count]
+    c_ids       int32[category count], ordered by category type
+    offsets     uint32[3 * question count + category count + 1]
+    q_nulls     uint8[question count], bit 0 null question, bit 1 null answer
+    c_nulls     uint8[category count], bit 0 null type
+    blob        utf-8 text of every string, back to back
+
+String i of the blob lives at blob[offsets[i]:offsets[i + 1]]. Question n
+owns strings 3n (question) and 3n + 1 (answer), string 3n + 2 holds the
+lowercased question used for searching, and category n owns string
+3 * question count + n (type).
+
+A NULL difficulty or category is stored as NULL_INT, and a NULL string as
+an empty string with its bit set in q_nulls or c_nulls, so rows read back
+exactly as Question.format() and Category.format() return them.
+"""
+SNAPSHOT_MAGIC = b'TRIVSNAP'
+SNAPSHOT_VERSION = 2
+HEADER = struct.Struct('=8sIIII')
+NULL_INT = -2 ** 31
+NULL_QUESTION = 1
+NULL_ANSWER = 2
+NULL_TYPE = 1
+
+
+def _int_or_null(value):
+    return NULL_INT if value is None else int(value)
+
+
+def _null_int(value):
+    return None if value == NULL_INT else value
+
+
+"""
+write_snapshot(path, questions, categories)
+    writes formatted question and category dicts to a snapshot file
+
+The file is written next to `path` and then renamed over it, so workers
+that already have the old snapshot mapped keep reading the old contents.
+"""
+def write_snapshot(path, questions, categories):
+    questions = sorted(questions, key=lambda question: question['id'])
+    # Postgres sorts NULL types last in ORDER BY type
+    categories = sorted(categories,
+                        key=lambda category: (category['type'] is None, category['type'] or ''))
+
+    strings = []
+    question_nulls = array('B')
+    for question in questions:
+        strings.append(question['question'] or '')
+        strings.append(question['answer'] or '')
+        strings.append((question['question'] or '').lower())
+        question_nulls.append((NULL_QUESTION if question['question'] is None else 0)
+                              | (NULL_ANSWER if question['answer'] is None else 0))
+
+    category_nulls = array('B')
+    for category in categories:
+        strings.append(category['type'] or '')
+        category_nulls.append(NULL_TYPE if category['type'] is None else 0)
+
+    blob = bytearray()
+    offsets = array('I', [0])
+    for string in strings:
+        blob += string.encode('utf-8')
+        offsets.append(len(blob))
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                         suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(SNAPSHOT_MAGIC,
+                                            SNAPSHOT_VERSION,
+                                            len(questions),
+                                            len(categories),
+                                            len(blob)))
+            array('i', [q['id'] for q in questions]).tofile(snapshot_file)
+            array('i', [_int_or_null(q['difficulty']) for q in questions]).tofile(snapshot_file)
+            array('i', [_int_or_null(q['category']) for q in questions]).tofile(snapshot_file)
+            array('i', [c['id'] for c in categories]).tofile(snapshot_file)
+            offsets.tofile(snapshot_file)
+            question_nulls.tofile(snapshot_file)
+            category_nulls.tofile(snapshot_file)
+            snapshot_file.write(blob)
+        # mkstemp creates the file private to its owner
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+"""
+export_snapshot(path)
+    dumps the questions and categories tables bound by setup_db to a snapshot
+"""
+def export_snapshot(path):
+    write_snapshot(path,
+                   [question.format() for question in Question.query.all()],
+                   [category.format() for category in Category.query.all()])
+
+
+"""
+QuestionSnapshot
+
+Memory-mapped view over a snapshot file. The integer columns are memoryviews
+straight into the mapping, so worker processes that load the same file share
+its pages instead of each holding a copy of the tables. `version` identifies
+the mapped file, taken from the same descriptor so a concurrent export cannot
+swap it.
+"""
+class QuestionSnapshot:
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = os.fstat(snapshot_file.fileno())
+
+        self.version = f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+
+        buffer = memoryview(self._mmap)
+        magic, version, question_count, category_count, blob_size = \
+            HEADER.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f'{path} is not a version {SNAPSHOT_VERSION} trivia snapshot')
+
+        self.question_count = question_count
+        self.category_count = category_count
+
+        position = HEADER.size
+
+        def column(typecode, length):
+            nonlocal position
+            size = length * struct.calcsize(typecode)
+            view = buffer[position:position + size].cast(typecode)
+            position += size
+            return view
+
+        self._question_ids = column('i', question_count)
+        self._difficulties = column('i', question_count)
+        self._question_categories = column('i', question_count)
+        self._category_ids = column('i', category_count)
+        self._offsets = column('I', 3 * question_count + category_count + 1)
+        self._question_nulls = column('B', question_count)
+        self._category_nulls = column('B', category_count)
+        self._blob = buffer[position:position + blob_size]
+
+    def _string(self, index):
+        return str(self._blob[self._offsets[index]:self._offsets[index + 1]], 'utf-8')
+
+    def format_question(self, row):
+        nulls = self._question_nulls[row]
+        category = _null_int(self._question_categories[row])
+        return {
+            'id': self._question_ids[row],
+            'question': None if nulls & NULL_QUESTION else self._string(3 * row),
+            'answer': None if nulls & NULL_ANSWER else self._string(3 * row + 1),
+            # Question.category is a String column, so match Question.format()
+            'category': None if category is None else str(category),
+            'difficulty': _null_int(self._difficulties[row])
+            }
+
+    def categories(self):
+        # Categories are stored ordered by type, matching get_categories
+        base = 3 * self.question_count
+        return {self._category_ids[row]:
+                    None if self._category_nulls[row] & NULL_TYPE else self._string(base + row)
+                for row in range(self.category_count)}
+
+    def questions(self, start=0, end=None):
+        return [self.format_question(row)
+                for row in range(self.question_count)[start:end]]
+
+    def questions_in_category(self, category_id):
+        return [self.format_question(row)
+                for row in range(self.question_count)
+                if self._question_categories[row] == category_id]
+
+    def search(self, search_term):
+        search_term = search_term.lower()
+        return [self.format_question(row)
+                for row in range(self.question_count)
+                if search_term in self._string(3 * row + 2)]
+
+    def quiz_candidates(self, category_id, previous_questions):
+        # category_id of None means every category is in play
+        previous_questions = set(previous_questions)
+        return [row for row in range(self.question_count)
+                if self._question_ids[row] not in previous_questions
+                and (category_id is None
+                     or self._question_categories[row] == category_id)]
+
+
+"""
+load_snapshot(path)
+    opens a snapshot file for read-only serving
+"""
+def load_snapshot(path):
+    return QuestionSnapshot(path)
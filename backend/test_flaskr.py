@@ -1,10 +1,16 @@
+import gzip
 import os
+import tempfile
+import threading
 import unittest
 import json
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from models import setup_db, table_versions, Question, Category
+from snapshot import write_snapshot, load_snapshot
+from throttle import SingleFlight, TokenBucketLimiter
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -221,6 +227,90 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Resource Not Found')
 
+    # Implementing a test to ensure a new question changes the listing ETag
+    def test_get_questions_etag_changes_after_create(self):
+        res = self.client().get('/questions')
+        etag = res.headers['ETag']
+
+        # Nothing changed yet, so the old ETag is still current
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        self.client().post('/questions', json={
+            'question': 'What is the capital of Peru?',
+            'answer': 'Lima',
+            'difficulty': 1,
+            'category': 3
+            })
+
+        # The questions table version moved on, so the page is sent again
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    # Implementing a test to ensure a coalesced page is tagged with the version it read
+    def test_coalesced_questions_keep_their_etag(self):
+        started = threading.Event()
+        release = threading.Event()
+        responses = {}
+        leader_calls = []
+
+        def blocking_table_versions(*names):
+            versions = table_versions(*names)
+            if threading.current_thread() is leader:
+                # The first call is the ETag pre-check, the second is inside
+                # the coalesced page query
+                leader_calls.append(names)
+                if len(leader_calls) == 2:
+                    started.set()
+                    release.wait()
+            return versions
+
+        def get_page(name):
+            responses[name] = self.client().get('/questions?page=1')
+
+        with mock.patch('flaskr.table_versions', blocking_table_versions):
+            # The leader reads the versions and holds its page query open
+            leader = threading.Thread(target=get_page, args=('leader',))
+            leader.start()
+            started.wait()
+
+            # A write lands, then the follower reads the new version and joins
+            self.client().post('/questions', json={
+                'question': 'What is the capital of Chile?',
+                'answer': 'Santiago',
+                'difficulty': 1,
+                'category': 3
+                })
+            follower = start_follower(lambda: get_page('follower'))
+            release.set()
+            leader.join()
+            follower.join()
+
+        # The follower got the leader's older body, so it must get its ETag too
+        etag = responses['follower'].headers['ETag']
+        self.assertEqual(etag, responses['leader'].headers['ETag'])
+
+        res = self.client().get('/questions?page=1', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+
+    # Implementing a test to ensure the export-snapshot command dumps the database
+    def test_export_snapshot_command(self):
+        handle, snapshot_path = tempfile.mkstemp(suffix='.snapshot')
+        os.close(handle)
+
+        try:
+            result = self.app.test_cli_runner().invoke(
+                args=['export-snapshot', snapshot_path])
+            snapshot = load_snapshot(snapshot_path)
+
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(snapshot.question_count, Question.query.count())
+            self.assertEqual(snapshot.category_count, Category.query.count())
+        finally:
+            os.remove(snapshot_path)
+
     # Implementing a test to ensure playing a quiz works properly
     def test_play_quiz_success(self):
         # Implementing sample round data
@@ -258,6 +348,277 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Unable to process request')
 
+def start_follower(target):
+    """Run target in a thread and return it once it waits on an Event."""
+    waiting = threading.Event()
+    original_wait = threading.Event.wait
+
+    def wait(event, timeout=None):
+        if threading.current_thread() is follower:
+            waiting.set()
+        return original_wait(event, timeout)
+
+    follower = threading.Thread(target=target)
+    with mock.patch.object(threading.Event, 'wait', wait):
+        follower.start()
+        original_wait(waiting)
+    return follower
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """This class represents the read-only snapshot test case"""
+
+    def setUp(self):
+        """Write a small snapshot and serve it without a database."""
+        handle, self.snapshot_path = tempfile.mkstemp(suffix='.snapshot')
+        os.close(handle)
+        write_snapshot(self.snapshot_path, [
+            {'id': 10, 'question': 'Which is the only team to play in every soccer World Cup tournament?',
+             'answer': 'Brazil', 'category': 6, 'difficulty': 3},
+            {'id': 15, 'question': 'The Taj Mahal is located in which Indian city?',
+             'answer': 'Agra', 'category': 3, 'difficulty': 2},
+        ], [
+            {'id': 6, 'type': 'Sports'},
+            {'id': 3, 'type': 'Geography'},
+        ])
+        self.app = create_app({'SNAPSHOT_PATH': self.snapshot_path})
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        """Executed after reach test"""
+        os.remove(self.snapshot_path)
+
+    def test_get_categories_from_snapshot(self):
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['categories'], {'3': 'Geography', '6': 'Sports'})
+
+    def test_get_questions_from_snapshot(self):
+        res = self.client().get('/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 2)
+        self.assertEqual([question['id'] for question in data['questions']], [10, 15])
+
+    def test_get_categories_from_empty_snapshot_404(self):
+        write_snapshot(self.snapshot_path, [], [])
+        res = create_app({'SNAPSHOT_PATH': self.snapshot_path}).test_client().get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['message'], 'Resource Not Found')
+
+    def test_snapshot_keeps_null_columns(self):
+        null_question = {'id': 20, 'question': None, 'answer': None,
+                         'category': None, 'difficulty': None}
+        write_snapshot(self.snapshot_path, [null_question], [{'id': 1, 'type': None}])
+        snapshot = load_snapshot(self.snapshot_path)
+
+        self.assertEqual(snapshot.format_question(0), null_question)
+        self.assertEqual(snapshot.categories(), {1: None})
+
+    def test_get_category_questions_from_snapshot(self):
+        res = self.client().get('/categories/3/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['current_category'], 3)
+        self.assertEqual(data['questions'][0]['category'], '3')
+
+    def test_get_category_questions_from_snapshot_404(self):
+        res = self.client().get('/categories/1/questions')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['message'], 'Resource Not Found')
+
+    def test_export_snapshot_replaces_file(self):
+        # Exporting over a snapshot that is being served swaps in a new file
+        old_inode = os.stat(self.snapshot_path).st_ino
+        write_snapshot(self.snapshot_path, [], [])
+
+        self.assertNotEqual(os.stat(self.snapshot_path).st_ino, old_inode)
+        self.assertEqual(self.client().get('/categories/3/questions').status_code, 200)
+
+    def test_search_questions_from_snapshot(self):
+        res = self.client().post('/questions/search', json={'searchTerm': 'taj mahal'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions'][0]['answer'], 'Agra')
+
+    def test_play_quiz_from_snapshot(self):
+        res = self.client().post('/quiz', json={
+            'previous_questions': [15],
+            'quiz_category': {'type': 'click', 'id': 0}
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['id'], 10)
+
+    def test_delete_question_from_snapshot_405(self):
+        res = self.client().delete('/questions/10')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 405)
+        self.assertEqual(data['message'], 'Method Not Allowed')
+
+    def test_snapshot_version_matches_mapped_file(self):
+        snapshot = load_snapshot(self.snapshot_path)
+        stat = os.stat(self.snapshot_path)
+
+        # Replacing the file later does not change the loaded snapshot's version
+        write_snapshot(self.snapshot_path, [], [])
+
+        self.assertEqual(snapshot.version, f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+        self.assertNotEqual(load_snapshot(self.snapshot_path).version, snapshot.version)
+
+    def test_get_questions_304(self):
+        res = self.client().get('/questions')
+        etag = res.headers['ETag']
+
+        # Asking again with the same ETag returns no body
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_get_questions_gzip(self):
+        app = create_app({'SNAPSHOT_PATH': self.snapshot_path,
+                          'COMPRESSION_MIN_SIZE': 0})
+
+        res = app.test_client().get('/questions', headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(data['total_questions'], 2)
+
+    def test_get_questions_not_compressed_below_min_size(self):
+        res = self.client().get('/questions', headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(res.data)
+
+        # The two question listing is well under COMPRESSION_MIN_SIZE
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(data['total_questions'], 2)
+
+    def test_export_snapshot_command_missing_on_snapshot_node(self):
+        result = self.app.test_cli_runner().invoke(
+            args=['export-snapshot', self.snapshot_path])
+
+        self.assertNotEqual(result.exit_code, 0)
+
+    def test_search_questions_429(self):
+        app = create_app({'SNAPSHOT_PATH': self.snapshot_path,
+                          'RATE_LIMIT_PER_SECOND': 0.001,
+                          'RATE_LIMIT_BURST': 1})
+
+        # The first search takes the only token, the second is refused
+        app.test_client().post('/questions/search', json={'searchTerm': 'agra'})
+        res = app.test_client().post('/questions/search', json={'searchTerm': 'agra'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Too Many Requests')
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+
+    def test_preflight_does_not_use_rate_limit(self):
+        app = create_app({'SNAPSHOT_PATH': self.snapshot_path,
+                          'RATE_LIMIT_PER_SECOND': 0.001,
+                          'RATE_LIMIT_BURST': 1})
+
+        app.test_client().options('/questions/search')
+        res = app.test_client().post('/questions/search', json={'searchTerm': 'agra'})
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_rate_limit_per_forwarded_client(self):
+        app = create_app({'SNAPSHOT_PATH': self.snapshot_path,
+                          'RATE_LIMIT_PER_SECOND': 0.001,
+                          'RATE_LIMIT_BURST': 1,
+                          'TRUSTED_PROXIES': 1})
+
+        # Both requests come through the same proxy for different clients
+        for client in ('203.0.113.1', '203.0.113.2'):
+            res = app.test_client().post('/questions/search',
+                                         json={'searchTerm': 'agra'},
+                                         headers={'X-Forwarded-For': client})
+            self.assertEqual(res.status_code, 200)
+
+
+class ThrottleTestCase(unittest.TestCase):
+    """This class represents the request coalescing and rate limiting test case"""
+
+    def test_single_flight_shares_result(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def slow_query():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'categories'
+
+        leader = threading.Thread(
+            target=lambda: results.append(single_flight.do('categories', slow_query)))
+        leader.start()
+        started.wait()
+
+        # Only release the leader once the follower has joined its call
+        follower = start_follower(
+            lambda: results.append(single_flight.do('categories', slow_query)))
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['categories', 'categories'])
+
+    def test_token_bucket_limits_each_client(self):
+        rate_limiter = TokenBucketLimiter(rate=0.001, capacity=2)
+
+        self.assertTrue(rate_limiter.allow('10.0.0.1'))
+        self.assertTrue(rate_limiter.allow('10.0.0.1'))
+        self.assertFalse(rate_limiter.allow('10.0.0.1'))
+        self.assertTrue(rate_limiter.allow('10.0.0.2'))
+
+    def test_token_bucket_retry_after(self):
+        rate_limiter = TokenBucketLimiter(rate=0.5, capacity=1)
+        rate_limiter.allow('10.0.0.1')
+
+        # An empty bucket needs a whole token, two seconds at 0.5 per second
+        self.assertAlmostEqual(rate_limiter.retry_after('10.0.0.1'), 2, places=1)
+        self.assertEqual(rate_limiter.retry_after('10.0.0.2'), 0)
+
+    def test_token_bucket_evicts_least_recent_client(self):
+        rate_limiter = TokenBucketLimiter(rate=0.001, capacity=1, max_clients=2)
+
+        rate_limiter.allow('10.0.0.1')
+        rate_limiter.allow('10.0.0.2')
+        rate_limiter.allow('10.0.0.3')
+
+        # 10.0.0.1 was dropped and starts with a full bucket again
+        self.assertEqual(len(rate_limiter._buckets), 2)
+        self.assertTrue(rate_limiter.allow('10.0.0.1'))
+        self.assertFalse(rate_limiter.allow('10.0.0.3'))
+
+    def test_token_bucket_rejects_non_positive_rate(self):
+        with self.assertRaises(ValueError):
+            TokenBucketLimiter(rate=0, capacity=1)
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+
+"""
+SingleFlight
+
+Collapses concurrent calls that share a key into one. The first caller runs
+the function; callers that arrive while it is still running wait for it and
+get the same result (or the same exception). Nothing is cached once the
+call finishes, so the next request after that queries again.
+"""
+class SingleFlight:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+"""
+TokenBucketLimiter
+
+Keeps one token bucket per client. Each bucket holds at most `capacity`
+tokens and refills at `rate` tokens per second; a request is allowed when
+it can take a token. Once more than `max_clients` are tracked, the bucket
+that was used least recently is dropped, so that client starts full again.
+"""
+class TokenBucketLimiter:
+
+    def __init__(self, rate, capacity, max_clients=10000):
+        if rate <= 0:
+            raise ValueError(f'rate must be positive, got {rate}')
+        if capacity < 1:
+            raise ValueError(f'capacity must be at least 1, got {capacity}')
+
+        self.rate = rate
+        self.capacity = capacity
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def allow(self, client):
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.get(client, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self._buckets[client] = (tokens, now)
+            self._buckets.move_to_end(client)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+
+        return allowed
+
+    def retry_after(self, client):
+        # Seconds until the client's bucket holds a whole token again
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated = self._buckets.get(client, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+
+        return max(0.0, (1 - tokens) / self.rate)